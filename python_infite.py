@@ -1,5 +1,4 @@
 import argparse
-import random
 import sys
 import os
 import json
@@ -15,6 +14,18 @@ except ImportError as e:
     print("pip install numpy librosa soundfile")
     sys.exit(1)
 
+# Optional: JIT-compiled graph construction (--graph-method numba)
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Optional: k-d tree graph construction (--graph-method kdtree)
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
 # Configuration weights from Eternal Jukebox (go-js.html)
 WEIGHTS = {
     'timbre': 1,
@@ -25,20 +36,40 @@ WEIGHTS = {
     'confidence': 1
 }
 
-def analyze_audio(file_path):
+# Per-beat features compared by the distance functions, in WEIGHTS order
+FEATURE_KEYS = list(WEIGHTS)
+
+# Added when two beats sit at different positions in the bar
+PHASE_PENALTY = 100
+
+def analyze_audio(file_path, analysis_sr=22050):
     """
     Analyzes the audio file to extract beats and features.
+    Analysis runs on a mono copy resampled to analysis_sr; the returned audio
+    keeps the file's own sample rate for playback.
     """
     print(f"Analyzing {file_path}...")
     try:
-        y, sr = librosa.load(file_path)
+        y_playback, sr_playback = librosa.load(file_path, sr=None, mono=True)
     except Exception as e:
         print(f"Error loading audio file: {e}")
         sys.exit(1)
 
+    # Every transform below scales with the number of samples, and beats are
+    # located in seconds, so a lower analysis rate is nearly free to use.
+    sr = analysis_sr
+    y = librosa.resample(y_playback, orig_sr=sr_playback, target_sr=sr) if sr_playback != sr else y_playback
+
+    # One STFT is shared by the beat tracker, MFCC and loudness; the mel
+    # spectrogram below is the same one librosa would compute for each of
+    # beat_track and mfcc from y.
+    S = np.abs(librosa.stft(y))
+    log_mel = librosa.power_to_db(librosa.feature.melspectrogram(S=S**2, sr=sr))
+
     # Extract beats
     # Use librosa's beat tracker
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
+    onset_env = librosa.onset.onset_strength(S=log_mel, sr=sr, aggregate=np.median)
+    tempo, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
     beat_times = librosa.frames_to_time(beat_frames, sr=sr)
 
     # We need features synchronized to beats.
@@ -50,13 +81,12 @@ def analyze_audio(file_path):
     # - Confidence
 
     # 1. MFCC for Timbre (12 coefficients to match typical Spotify analysis)
-    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=12)
+    mfcc = librosa.feature.mfcc(S=log_mel, n_mfcc=12)
 
-    # 2. Chroma for Pitches
+    # 2. Chroma for Pitches (a constant-Q transform, so it can't reuse the STFT)
     chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
 
     # 3. Loudness (RMS converted to dB)
-    S, phase = librosa.magphase(librosa.stft(y))
     rms = librosa.feature.rms(S=S)
     loudness_db = librosa.amplitude_to_db(rms, ref=np.max)
 
@@ -73,78 +103,88 @@ def analyze_audio(file_path):
     # Note: beat_frames usually marks the *center* or *onset* of the beat.
     # For segmentation, we want intervals.
     # librosa.util.sync uses the beat frames as boundaries for aggregation.
+    # With pad=False it doesn't add the stretches before the first and after
+    # the last beat, so column i covers exactly beat_frames[i]..beat_frames[i+1].
+    # Result shape is (n_features, len(beat_frames) - 1).
 
-    mfcc_sync = librosa.util.sync(mfcc, beat_frames)
-    chroma_sync = librosa.util.sync(chroma, beat_frames)
-    loudness_sync = librosa.util.sync(loudness_db, beat_frames)
-
-    beats = []
-    # beat_times corresponds to the time of the beat markers.
     # We can treat the interval between beat_times[i] and beat_times[i+1] as the segment/quantum.
-
-    # However, sync returns N columns for N+1 boundaries? Or N boundaries?
-    # Documentation says: "beat_frames : ... frame indices of beat events"
-    # "aggregate_features is of shape (d, len(beat_frames))" if we assume beat_frames are centers?
-    # Actually librosa.util.sync treats them as boundaries if you pass them right,
-    # but strictly it "aggregates features between beat events".
-    # Result shape is (n_features, n_beats).
-
-    num_beats = mfcc_sync.shape[1]
-
-    # We need to handle the time segments carefully.
-    # The beat_times array has the timestamps of the beats.
-    # Let's assume the i-th column of sync features corresponds to the interval starting at beat_times[i].
-    # But we need duration.
-
-    for i in range(num_beats):
-        if i >= len(beat_times) - 1:
-            # Last beat, estimating duration from previous or until end of file
-            # If beat_times covers until end, good. If not, we approximate.
-            # beat_track usually doesn't include 0.0 or the very end unless a beat is there.
-            continue
-
-        start = beat_times[i]
-        end = beat_times[i+1]
-        duration = end - start
-
-        # Features
-        timbre = mfcc_sync[:, i]
-        pitch = chroma_sync[:, i]
-
-        # Loudness
-        # We need start and max.
-        # sync gives average (or whatever func).
-        # Let's just use the average for both or try to be more precise if we had raw frames.
-        # For this script, using the synchronized average for both is a simplification.
-        l_val = loudness_sync[0, i]
-
-        beats.append({
-            'index': i,
-            'start': start,
-            'duration': duration,
-            'timbre': timbre,
-            'pitch': pitch,
-            'loudness_max': l_val,
-            'loudness_start': l_val, # Approximation
-            'confidence': 1.0, # Approximation
-            'neighbors': []
-        })
-
-    return y, sr, beats
+    # beat_track usually doesn't include 0.0 or the very end unless a beat is there.
+    num_beats = max(len(beat_times) - 1, 0)
+
+    # Features are kept in float32 from here on: it halves the memory the
+    # distance computations stream through and doubles their SIMD width.
+    mfcc_sync = librosa.util.sync(mfcc, beat_frames, pad=False).astype(np.float32, copy=False)
+    chroma_sync = librosa.util.sync(chroma, beat_frames, pad=False).astype(np.float32, copy=False)
+
+    # Loudness
+    # We need start and max: the loudest frame of each beat, and the frame
+    # the beat starts on.
+    loudness_max = librosa.util.sync(loudness_db, beat_frames, aggregate=np.max, pad=False)
+    loudness_max = np.ascontiguousarray(loudness_max[0], dtype=np.float32)
+    loudness_start = np.ascontiguousarray(loudness_db[0, beat_frames[:num_beats]], dtype=np.float32)
+
+    # Beat i spans beat markers i and i + 1, so consecutive beats share a
+    # boundary sample.
+    marker_samples = (beat_times * sr_playback).astype(np.int64)
+
+    # Beats are stored as a struct of arrays, one row per beat, so the
+    # pairwise comparisons walk contiguous memory.
+    beats = {
+        'index': np.arange(num_beats),
+        # Position in the bar, assuming 4/4 (see phase_penalty)
+        'phase': (np.arange(num_beats) % 4).astype(np.int8),
+        # Start times stay float64: they locate samples in long files
+        'start': beat_times[:num_beats],
+        # Bounds of each beat in the playback audio, so playback is pure slicing
+        'start_sample': marker_samples[:num_beats],
+        'end_sample': marker_samples[1:num_beats + 1],
+        'duration': np.diff(beat_times)[:num_beats].astype(np.float32),
+        'timbre': np.ascontiguousarray(mfcc_sync.T),
+        'pitch': np.ascontiguousarray(chroma_sync.T),
+        'loudness_max': loudness_max,
+        'loudness_start': loudness_start,
+        'confidence': np.ones(num_beats, dtype=np.float32), # Approximation
+        # Filled in by generate_graph, in CSR form: the neighbours of beat i
+        # are neighbors[neighbor_indptr[i]:neighbor_indptr[i + 1]]
+        'neighbor_indptr': np.zeros(num_beats + 1, dtype=np.int32),
+        'neighbors': np.empty(0, dtype=np.int32),
+        'neighbor_distances': np.empty(0, dtype=np.float32)
+    }
+
+    return y_playback, sr_playback, beats
 
 def euclidean_distance(v1, v2):
-    return np.linalg.norm(v1 - v2)
+    """
+    Euclidean distances between every row of v1 and every row of v2.
+    Uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b so the bulk of the work is a
+    single float32 matrix product instead of an (N, M, d) difference array.
+    """
+    # Distances are translation invariant; centring first keeps the
+    # squared norms small so the expansion doesn't lose float32 precision.
+    offset = v2.mean(axis=0)
+    v1 = v1 - offset
+    v2 = v2 - offset
+
+    sq_dist = (v1 * v1).sum(axis=1)[:, None] + (v2 * v2).sum(axis=1)[None, :]
+    sq_dist -= 2 * (v1 @ v2.T)
+    np.maximum(sq_dist, 0, out=sq_dist)
+    return np.sqrt(sq_dist, out=sq_dist)
 
 def get_seg_distances(seg1, seg2):
     """
-    Calculates the weighted distance between two segments.
+    Calculates the weighted distance between two sets of segments.
+    Returns a matrix with one row per segment in seg1 and one column per
+    segment in seg2.
     """
+    def scalar_distance(key):
+        return np.abs(seg1[key][:, None] - seg2[key][None, :])
+
     timbre = euclidean_distance(seg1['timbre'], seg2['timbre'])
     pitch = euclidean_distance(seg1['pitch'], seg2['pitch'])
-    sloudStart = abs(seg1['loudness_start'] - seg2['loudness_start'])
-    sloudMax = abs(seg1['loudness_max'] - seg2['loudness_max'])
-    duration = abs(seg1['duration'] - seg2['duration'])
-    confidence = abs(seg1['confidence'] - seg2['confidence'])
+    sloudStart = scalar_distance('loudness_start')
+    sloudMax = scalar_distance('loudness_max')
+    duration = scalar_distance('duration')
+    confidence = scalar_distance('confidence')
 
     distance = (timbre * WEIGHTS['timbre'] +
                 pitch * WEIGHTS['pitch'] +
@@ -154,100 +194,432 @@ def get_seg_distances(seg1, seg2):
                 confidence * WEIGHTS['confidence'])
     return distance
 
-def generate_graph(beats, threshold):
+def get_pair_distances(beats, i, j):
+    """
+    Calculates the weighted distance, including the bar-phase penalty,
+    between beats i[k] and j[k] for each k.
+    """
+    def vector_distance(key):
+        diff = beats[key][i] - beats[key][j]
+        # Row-wise sqrt(d . d); cheaper than np.linalg.norm's generic dispatch
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+    def scalar_distance(key):
+        return np.abs(beats[key][i] - beats[key][j])
+
+    distance = (vector_distance('timbre') * WEIGHTS['timbre'] +
+                vector_distance('pitch') * WEIGHTS['pitch'] +
+                scalar_distance('loudness_start') * WEIGHTS['loudness_start'] +
+                scalar_distance('loudness_max') * WEIGHTS['loudness_max'] +
+                scalar_distance('duration') * WEIGHTS['duration'] +
+                scalar_distance('confidence') * WEIGHTS['confidence'])
+    return distance + (beats['phase'][i] != beats['phase'][j]) * np.float32(PHASE_PENALTY)
+
+def phase_penalty(phase1, phase2):
+    """
+    Bar-phase penalty between every beat of phase1 and every beat of phase2,
+    as a float32 matrix built from one comparison instead of a branch per pair.
+    """
+    return (phase1[:, None] != phase2[None, :]) * np.float32(PHASE_PENALTY)
+
+def beat_rows(beats, rows):
+    """
+    Returns the features of the beats selected by rows, in the same layout
+    as beats, for use with get_seg_distances.
+    """
+    return {key: beats[key][rows] for key in FEATURE_KEYS + ['phase']}
+
+def concat_edges(src, dest, dist):
+    """
+    Concatenates per-tile edge arrays, allowing for there being none.
+    """
+    if not src:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    return np.concatenate(src), np.concatenate(dest), np.concatenate(dist)
+
+def mirror_pairs(src, dest, dist):
+    """
+    Turns pairs listed once into edges in both directions.
+    """
+    return np.concatenate((src, dest)), np.concatenate((dest, src)), np.concatenate((dist, dist))
+
+def keep_nearest(src, dest, dist, max_neighbors):
+    """
+    Keeps only the max_neighbors closest edges of each source beat.
+    """
+    # Rank each beat's edges by distance; an edge's rank is its position
+    # after the start of its beat's run.
+    order = np.lexsort((dist, src))
+    src, dest, dist = src[order], dest[order], dist[order]
+    row_start = np.searchsorted(src, src, side='left')
+    keep = np.arange(len(src)) - row_start < max_neighbors
+    return src[keep], dest[keep], dist[keep]
+
+def find_edges_numpy(beats, threshold, max_neighbors=0, tile_size=128):
+    """
+    Finds the edges between beats closer than the threshold using dense NumPy
+    distance matrices. Returns directed (source, dest, distance) arrays; if
+    max_neighbors is set, each beat only keeps that many of its closest
+    matches.
+    """
+    num_beats = len(beats['phase'])
+    src, dest, dist = [], [], []
+
+    # Compare tile_size beats at a time, so the working set stays in cache
+    # and memory doesn't grow with N^2. Without a cap the distance is
+    # symmetric, so each tile only needs the later beats (the upper
+    # triangle); with one, a tile needs whole rows to rank them.
+    for first in range(0, num_beats, tile_size):
+        rows = beat_rows(beats, slice(first, first + tile_size))
+        col_start = 0 if max_neighbors else first
+        cols = beat_rows(beats, slice(col_start, None))
+
+        # In the JS code, it sums distances of overlapping segments for beats.
+        # Here we simplified beats to be the segments themselves.
+        block = get_seg_distances(rows, cols)
+
+        # JS adds a penalty if indexInParent is different (beat position in bar)
+        #    "var pdistance = q1.indexInParent == q2.indexInParent ? 0 : 100;"
+        #    Yes, it enforces rhythmic structure.
+        # We don't have bar analysis here easily, so enforce a simple 4/4
+        # assumption for rhythm continuity using the beat index % 4.
+        block += phase_penalty(rows['phase'], cols['phase'])
+
+        if max_neighbors:
+            # A beat is never its own neighbour
+            diagonal = np.arange(block.shape[0])
+            block[diagonal, diagonal + first] = np.inf
+
+            if max_neighbors < block.shape[1]:
+                nearest = np.argpartition(block, max_neighbors - 1, axis=1)[:, :max_neighbors]
+            else:
+                nearest = np.broadcast_to(np.arange(block.shape[1]), block.shape)
+            nearest_dist = np.take_along_axis(block, nearest, axis=1)
+            i, k = np.nonzero(nearest_dist < threshold)
+            j = nearest[i, k]
+            tile_dist = nearest_dist[i, k]
+        else:
+            # The block starts on the diagonal, so its own upper triangle holds
+            # the pairs with dest > source. A beat is never its own neighbour.
+            i, j = np.nonzero(np.triu(block < threshold, 1))
+            tile_dist = block[i, j]
+
+        src.append(i + first)
+        dest.append(j + col_start)
+        dist.append(tile_dist)
+
+    src, dest, dist = concat_edges(src, dest, dist)
+    return (src, dest, dist) if max_neighbors else mirror_pairs(src, dest, dist)
+
+# Timbre and pitch are always 12-dimensional (12 MFCCs, 12 chroma bins)
+FEATURE_DIMS = 12
+
+if numba is not None:
+    @numba.njit(fastmath=True, cache=True, inline='always')
+    def _distance12(a, b):
+        """
+        Euclidean distance between two 12-dim vectors. The fixed trip count
+        lets LLVM unroll and vectorize the loop completely. Compiled lazily,
+        with the kernels below, so other graph methods don't pay for it.
+        """
+        s = np.float32(0.0)
+        for k in range(FEATURE_DIMS):
+            t = a[k] - b[k]
+            s += t * t
+        return np.sqrt(s)
+
+    @numba.njit(fastmath=True, cache=True)
+    def _beat_distance(timbre, pitch, loud_start, loud_max, duration, confidence, phase, weights, penalty, i, j):
+        """
+        Weighted distance between beats i and j, see get_seg_distances.
+        """
+        dist = (_distance12(timbre[i], timbre[j]) * weights[0] +
+                _distance12(pitch[i], pitch[j]) * weights[1] +
+                abs(loud_start[i] - loud_start[j]) * weights[2] +
+                abs(loud_max[i] - loud_max[j]) * weights[3] +
+                abs(duration[i] - duration[j]) * weights[4] +
+                abs(confidence[i] - confidence[j]) * weights[5])
+        # Bar-phase penalty, without a branch
+        return dist + penalty * (phase[i] != phase[j])
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _build_edges(timbre, pitch, loud_start, loud_max, duration, confidence, phase, weights, penalty, threshold):
+        """
+        Parallel threshold scan over all pairs of beats i < j. A first pass
+        counts the edges of each beat so the second can write them without
+        locking.
+        """
+        n = timbre.shape[0]
+        counts = np.zeros(n, np.int64)
+        for i in numba.prange(n):
+            count = 0
+            for j in range(i + 1, n):
+                if _beat_distance(timbre, pitch, loud_start, loud_max, duration,
+                                  confidence, phase, weights, penalty, i, j) < threshold:
+                    count += 1
+            counts[i] = count
+
+        offsets = np.zeros(n + 1, np.int64)
+        offsets[1:] = np.cumsum(counts)
+        src = np.empty(offsets[n], np.int32)
+        dest = np.empty(offsets[n], np.int32)
+        dists = np.empty(offsets[n], np.float32)
+        for i in numba.prange(n):
+            pos = offsets[i]
+            for j in range(i + 1, n):
+                dist = _beat_distance(timbre, pitch, loud_start, loud_max, duration,
+                                      confidence, phase, weights, penalty, i, j)
+                if dist < threshold:
+                    src[pos] = i
+                    dest[pos] = j
+                    dists[pos] = dist
+                    pos += 1
+        return src, dest, dists
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _build_nearest_edges(timbre, pitch, loud_start, loud_max, duration, confidence, phase, weights, penalty,
+                             threshold, k):
+        """
+        Parallel scan keeping the k closest beats under the threshold for each
+        beat, in a fixed (n, k) buffer. Unused slots have dest -1.
+        """
+        n = timbre.shape[0]
+        dest = np.full((n, k), -1, np.int32)
+        dists = np.full((n, k), np.inf, np.float32)
+        for i in numba.prange(n):
+            count = 0
+            worst = 0
+            for j in range(n):
+                if i == j:
+                    continue
+                dist = _beat_distance(timbre, pitch, loud_start, loud_max, duration,
+                                      confidence, phase, weights, penalty, i, j)
+                if dist >= threshold:
+                    continue
+                if count < k:
+                    slot = count
+                    count += 1
+                elif dist < dists[i, worst]:
+                    slot = worst
+                else:
+                    continue
+                dest[i, slot] = j
+                dists[i, slot] = dist
+                # Once the buffer is full, track the slot to evict next
+                if count == k:
+                    worst = 0
+                    for s in range(1, k):
+                        if dists[i, s] > dists[i, worst]:
+                            worst = s
+        return dest, dists
+
+def find_edges_numba(beats, threshold, max_neighbors=0):
+    """
+    Same as find_edges_numpy, but scans the pairs in a JIT-compiled parallel
+    loop, so no N x N matrix is ever held in memory.
+    """
+    for key in ('timbre', 'pitch'):
+        if beats[key].shape[1:] != (FEATURE_DIMS,):
+            raise ValueError(f"{key} must have {FEATURE_DIMS} dimensions, got {beats[key].shape[1:]}")
+
+    weights = np.array([WEIGHTS[key] for key in FEATURE_KEYS], dtype=np.float32)
+    arrays = [np.ascontiguousarray(beats[key], dtype=np.float32) for key in FEATURE_KEYS]
+    phase = np.ascontiguousarray(beats['phase'], dtype=np.int8)
+    if max_neighbors:
+        nearest, nearest_dist = _build_nearest_edges(*arrays, phase, weights, np.float32(PHASE_PENALTY),
+                                                     np.float32(threshold), max_neighbors)
+        src, slot = np.nonzero(nearest >= 0)
+        return src, nearest[src, slot], nearest_dist[src, slot]
+    return mirror_pairs(*_build_edges(*arrays, phase, weights, np.float32(PHASE_PENALTY), np.float32(threshold)))
+
+def find_edges_kdtree(beats, threshold, max_neighbors=0, tile_size=256):
+    """
+    Same as find_edges_numpy, but finds candidate pairs with k-d tree radius
+    queries, which scales far better than N x N on long songs.
+    """
+    if len(beats['phase']) == 0:
+        return concat_edges([], [], [])
+
+    # Each feature is scaled by its weight, so the Euclidean distance between
+    # two rows is the root-sum-square of the weighted per-feature distances.
+    # That never exceeds their plain sum (the real distance), so a radius
+    # query returns every true neighbour plus a few extra to filter out.
+    columns = []
+    for key in FEATURE_KEYS:
+        column = beats[key].reshape(len(beats[key]), -1)
+        columns.append(column * np.float32(WEIGHTS[key]))
+    points = np.hstack(columns)
+
+    # The bar-phase penalty is constant per pair of phases, so query each
+    # pair of phase groups separately with the radius it leaves over.
+    phases = np.unique(beats['phase'])
+    groups = {phase: np.flatnonzero(beats['phase'] == phase) for phase in phases}
+    trees = {phase: cKDTree(points[members]) for phase, members in groups.items()}
+
+    def radius(a, b):
+        return threshold - (0 if a == b else PHASE_PENALTY)
+
+    src, dest, dist = [], [], []
+    if not max_neighbors:
+        # Each unordered pair of groups once, then mirror
+        for a in phases:
+            for b in phases[phases >= a]:
+                if radius(a, b) <= 0:
+                    continue
+                if a == b:
+                    pairs = trees[a].query_pairs(radius(a, b), output_type='ndarray')
+                    i, j = groups[a][pairs[:, 0]], groups[b][pairs[:, 1]]
+                else:
+                    pairs = trees[a].sparse_distance_matrix(trees[b], radius(a, b), output_type='ndarray')
+                    i, j = groups[a][pairs['i']], groups[b][pairs['j']]
+                pair_dist = get_pair_distances(beats, i, j)
+                close = pair_dist < threshold
+                src.append(i[close])
+                dest.append(j[close])
+                dist.append(pair_dist[close])
+        return mirror_pairs(*concat_edges(src, dest, dist))
+
+    # With a cap, query tile_size beats at a time against every group and
+    # keep each beat's closest matches, so only one tile's candidates are
+    # ever held at once.
+    for a in phases:
+        for first in range(0, len(groups[a]), tile_size):
+            rows = groups[a][first:first + tile_size]
+            tile_tree = cKDTree(points[rows])
+            tile_src, tile_dest = [], []
+            for b in phases:
+                if radius(a, b) <= 0:
+                    continue
+                pairs = tile_tree.sparse_distance_matrix(trees[b], radius(a, b), output_type='ndarray')
+                tile_src.append(rows[pairs['i']])
+                tile_dest.append(groups[b][pairs['j']])
+            if not tile_src:
+                continue
+
+            i, j = np.concatenate(tile_src), np.concatenate(tile_dest)
+            pair_dist = get_pair_distances(beats, i, j)
+            # A beat is never its own neighbour
+            close = (pair_dist < threshold) & (i != j)
+            i, j, pair_dist = keep_nearest(i[close], j[close], pair_dist[close], max_neighbors)
+            src.append(i)
+            dest.append(j)
+            dist.append(pair_dist)
+    return concat_edges(src, dest, dist)
+
+def edges_to_csr(num_beats, src, dest, dist):
+    """
+    Packs edges into CSR arrays (indptr[num_beats + 1], indices[E], distances[E]).
+    Edges may come in any order; each row is sorted by destination beat so
+    neighbour scans are monotonic and rows can be binary searched.
+    """
+    order = np.lexsort((dest, src))
+    src, dest, dist = src[order], dest[order], dist[order]
+
+    indptr = np.zeros(num_beats + 1, dtype=np.int32)
+    np.cumsum(np.bincount(src, minlength=num_beats), out=indptr[1:])
+    return indptr, dest.astype(np.int32), dist.astype(np.float32, copy=False)
+
+GRAPH_METHODS = {
+    'numpy': find_edges_numpy,
+    'numba': find_edges_numba,
+    'kdtree': find_edges_kdtree,
+}
+
+def generate_graph(beats, threshold, method='numpy', max_neighbors=16):
     """
     Connects beats based on similarity.
+    Each beat keeps at most max_neighbors of its closest matches (0 for all).
+    The builders apply the cap as they go, so it bounds the memory of the
+    build as well as of the graph, and evens out how often beats branch.
     """
     print(f"Generating graph with threshold {threshold}...")
-    edge_count = 0
 
-    for i, b1 in enumerate(beats):
-        for j, b2 in enumerate(beats):
-            if i == j:
-                continue
+    src, dest, dist = GRAPH_METHODS[method](beats, threshold, max_neighbors)
+
+    indptr, neighbors, distances = edges_to_csr(len(beats['index']), src, dest, dist)
+    beats['neighbor_indptr'] = indptr
+    beats['neighbors'] = neighbors
+    beats['neighbor_distances'] = distances
 
-            # Simple distance calculation (pairwise)
-            # In the JS code, it sums distances of overlapping segments for beats.
-            # Here we simplified beats to be the segments themselves.
-            dist = get_seg_distances(b1, b2)
-
-            # JS adds a penalty if indexInParent is different (beat position in bar)
-            # We don't have bar analysis here easily, so we skip that or could approximate with beat % 4.
-            # let's skip for now or add small penalty if absolute beat index % 4 is different?
-            # if (b1['index'] % 4) != (b2['index'] % 4):
-            #    dist += 100 # This would be huge. JS adds 100 if phase doesn't match?
-            #    "var pdistance = q1.indexInParent == q2.indexInParent ? 0 : 100;"
-            #    Yes, it enforces rhythmic structure.
-
-            # Let's try to enforce simple 4/4 assumption for rhythm continuity
-            if (b1['index'] % 4) != (b2['index'] % 4):
-                dist += 100
-
-            if dist < threshold:
-                b1['neighbors'].append({
-                    'dest': j,
-                    'distance': dist
-                })
-                edge_count += 1
-
-    print(f"Created {edge_count} edges.")
+    print(f"Created {len(neighbors)} edges.")
     return beats
 
-def generate_infinite_track(y, sr, beats, duration_minutes, branch_probability, output_path):
+def walk_beats(y, beats, target_samples, branch_probability):
     """
-    Generates the infinite track by following the graph.
+    Follows the graph from the first beat, yielding the audio of each beat
+    played until target_samples have been produced. The last segment is
+    cut short so the total is exactly target_samples.
     """
-    print(f"Generating {duration_minutes} minutes of audio...")
-
-    target_samples = int(duration_minutes * 60 * sr)
     generated_samples = 0
-
-    output_segments = []
+    start_samples = beats['start_sample']
+    end_samples = beats['end_sample']
 
     current_index = 0
+    indptr = beats['neighbor_indptr']
+
+    # Branch decisions are drawn in fixed-size batches rather than one
+    # random() call per beat, so their memory doesn't grow with the duration.
+    batch_size = 4096
+    step = batch_size
 
     while generated_samples < target_samples:
-        if current_index >= len(beats):
-            current_index = 0
+        if step == batch_size:
+            branch_coins = np.random.random(batch_size) < branch_probability
+            branch_picks = np.random.random(batch_size)
+            step = 0
 
-        beat = beats[current_index]
+        if current_index >= len(beats['start']):
+            current_index = 0
 
         # Get audio segment
-        start_sample = int(beat['start'] * sr)
-        end_sample = int((beat['start'] + beat['duration']) * sr)
+        start_sample = start_samples[current_index]
+        end_sample = min(end_samples[current_index], start_sample + target_samples - generated_samples)
 
-        # Append audio
-        segment = y[start_sample:end_sample]
-        output_segments.append(segment)
-        generated_samples += len(segment)
+        yield y[start_sample:end_sample]
+        generated_samples += end_sample - start_sample
 
         # Decide next beat
-        neighbors = beat['neighbors']
+        neighbors = beats['neighbors'][indptr[current_index]:indptr[current_index + 1]]
 
         # Sort neighbors by distance to prefer better matches?
         # JS logic picks one if available and chance is met.
 
-        jumped = False
-        if neighbors and random.random() < branch_probability:
+        if branch_coins[step] and neighbors.size:
             # Pick a random neighbor? Or weighted?
             # Let's pick uniformly from neighbors for variety
-            next_beat = random.choice(neighbors)
-            current_index = next_beat['dest']
-            jumped = True
-
-        if not jumped:
+            current_index = int(neighbors[int(branch_picks[step] * neighbors.size)])
+        else:
             current_index += 1
+        step += 1
 
-    # Concatenate and save
-    print("Concatenating audio...")
-    full_audio = np.concatenate(output_segments)
+def generate_infinite_track(y, sr, beats, duration_minutes, branch_probability, output_path, stream=False):
+    """
+    Generates the infinite track by following the graph.
+    With stream=True each beat is written straight to the output file, so
+    memory use doesn't grow with the duration.
+    """
+    print(f"Generating {duration_minutes} minutes of audio...")
 
-    # Trim if needed (though we just stopped loop)
-    if len(full_audio) > target_samples:
-        full_audio = full_audio[:target_samples]
+    target_samples = int(duration_minutes * 60 * sr)
+    segments = walk_beats(y, beats, target_samples, branch_probability)
+
+    if stream:
+        print(f"Streaming to {output_path}...")
+        with sf.SoundFile(output_path, 'w', samplerate=sr, channels=1) as f:
+            for segment in segments:
+                f.write(segment)
+        print("Done!")
+        return
+
+    # One buffer for the whole track, filled in place
+    output = np.empty(target_samples, dtype=y.dtype)
+    generated_samples = 0
+    for segment in segments:
+        output[generated_samples:generated_samples + len(segment)] = segment
+        generated_samples += len(segment)
 
     print(f"Saving to {output_path}...")
-    sf.write(output_path, full_audio, sr)
+    sf.write(output_path, output[:generated_samples], sr)
     print("Done!")
 
 def main():
@@ -255,8 +627,19 @@ def main():
     parser.add_argument('input_file', type=str, help='Path to the input audio file')
     parser.add_argument('--output', type=str, default='infinite.wav', help='Path to the output audio file')
     parser.add_argument('--duration', type=float, default=5.0, help='Target duration in minutes')
+    parser.add_argument('--analysis-sr', type=int, default=22050,
+                        help='Sample rate used for beat and feature analysis. 11025 roughly halves analysis time. '
+                             'Output keeps the input sample rate. Default 22050.')
     parser.add_argument('--threshold', type=float, default=60.0, help='Similarity threshold (lower is stricter). Default 60.')
+    parser.add_argument('--max-neighbors', type=int, default=16,
+                        help='Keep only this many of the closest matches per beat (0 keeps all). Default 16.')
     parser.add_argument('--prob', type=float, default=0.5, help='Branch probability (0.0 to 1.0). Default 0.5.')
+    parser.add_argument('--graph-method', type=str, default='numpy', choices=sorted(GRAPH_METHODS),
+                        help='How to build the similarity graph. "numba" requires numba, "kdtree" requires scipy '
+                             'and is fastest on long songs. Default numpy.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write audio to the output file as it is generated instead of buffering it. '
+                             'Uses constant memory for long durations.')
 
     args = parser.parse_args()
 
@@ -264,10 +647,19 @@ def main():
         print(f"File not found: {args.input_file}")
         sys.exit(1)
 
-    y, sr, beats = analyze_audio(args.input_file)
-    beats = generate_graph(beats, args.threshold)
+    if args.graph_method == 'numba' and numba is None:
+        print("Error: --graph-method numba requires numba.")
+        print("pip install numba")
+        sys.exit(1)
+    if args.graph_method == 'kdtree' and cKDTree is None:
+        print("Error: --graph-method kdtree requires scipy.")
+        print("pip install scipy")
+        sys.exit(1)
+
+    y, sr, beats = analyze_audio(args.input_file, args.analysis_sr)
+    beats = generate_graph(beats, args.threshold, args.graph_method, args.max_neighbors)
 
-    generate_infinite_track(y, sr, beats, args.duration, args.prob, args.output)
+    generate_infinite_track(y, sr, beats, args.duration, args.prob, args.output, args.stream)
 
 if __name__ == "__main__":
     main()